@@ -1,10 +1,11 @@
 import asyncio
-import json
 import logging
 import os
+import shutil
 import tempfile
 import time
 import uuid
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from typing import Dict, List, Optional, Any
@@ -13,10 +14,6 @@ import re
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from google.auth import default
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
-import subprocess
 from pydantic import BaseModel
 from .config import Config
 from .gdrive import GoogleDrive
@@ -24,6 +21,9 @@ from .gdrive import GoogleDrive
 logger = logging.getLogger(__name__)
 
 M3U_QUERY = "name contains '.m3u' and trashed=false"
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+# An EXTINF line immediately followed by its (non-comment) URL line, ignoring surrounding whitespace
+_EXTINF_RE = re.compile(r'^[^\S\n]*#EXTINF:([0-9.]+),(.*\S)[^\S\n]*\n[^\S\n]*([^#\s].*)$', re.M)
 
 class ProcessingJob(BaseModel):
     id: str
@@ -46,49 +46,89 @@ class DriveNotification(BaseModel):
 
 class AudioProcessor:
     def __init__(self):
-        self.executor = ThreadPoolExecutor(max_workers=Config.MAX_WORKERS)
+        # Blocking Drive/SMTP calls are network-bound, so size this pool for I/O rather than cores
+        self.io_executor = ThreadPoolExecutor(max_workers=Config.IO_WORKERS, thread_name_prefix='io')
         self.jobs: Dict[str, ProcessingJob] = {}
-        self.processed_files = set()
-        self.notification_channels = {}
+        # LRU of processed Drive file ids, bounded so long-running servers don't grow forever
+        self.processed_files: OrderedDict[str, None] = OrderedDict()
+        self._session: Optional[aiohttp.ClientSession] = None
+        # Each pipeline stage is bounded on its own resource so uploads overlap with encodes
+        self._ffmpeg_sem = asyncio.Semaphore(Config.MAX_WORKERS)
+        self._upload_sem = asyncio.Semaphore(Config.UPLOAD_WORKERS)
+        # Held from encode until upload, so encodes can't outrun uploads and fill the disk
+        self._scratch_sem = asyncio.Semaphore(Config.MAX_WORKERS + Config.UPLOAD_WORKERS)
+        # Drive modifiedTime of the newest playlist seen, so polls only list newer files
+        self._last_seen: Optional[str] = None
+        self._smtp: Optional[smtplib.SMTP] = None
+        self._smtp_lock = asyncio.Lock()
+        # Strong references to fire-and-forget tasks so they aren't garbage collected mid-flight
+        self._bg_tasks: set[asyncio.Task] = set()
 
     async def initialize(self):
-        await self.setup_google_services()
+        # asyncio.to_thread() runs on the loop's default executor
+        asyncio.get_running_loop().set_default_executor(self.io_executor)
+        # Credential discovery can hit the metadata server, keep it off the loop
+        await asyncio.to_thread(GoogleDrive.instance)
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=Config.MAX_WORKERS * 4,
+                limit_per_host=8,
+                ttl_dns_cache=300,
+                keepalive_timeout=30,
+                enable_cleanup_closed=True
+            ),
+            timeout=aiohttp.ClientTimeout(total=None, connect=15, sock_read=10)
+        )
         # this is triggering another call to check_for_new_m3u8_files because it starts fallback polling
         # await self.setup_push_notifications()
 
-    def get_most_recent_file(self, files: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
-        """Get the most recently modified file from a list of files"""
-        if not files:
-            return None
-            
-        most_recent = None
-        most_recent_time = None
-        
-        for file in files:
-            modified_time_str = file.get('modifiedTime')
-            if not modified_time_str:
-                continue
-                
-            # Convert ISO formatted timestamp to datetime
-            try:
-                modified_time = datetime.fromisoformat(modified_time_str.replace('Z', '+00:00'))
-                if most_recent_time is None or modified_time > most_recent_time:
-                    most_recent_time = modified_time
-                    most_recent = file
-            except ValueError as e:
-                logger.warning(f"Could not parse modifiedTime '{modified_time_str}' for file {file.get('name', 'unknown')}: {e}")
-                continue
-                
-        return most_recent
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._bg_tasks.add(task)
+        task.add_done_callback(self._bg_tasks.discard)
+        return task
 
-    async def check_for_new_m3u8_files(self, old_eps: dict[str, dict[str, str | int | float]]={}):
+    async def aclose(self):
+        """Wait for background work, then release the shared HTTP session and SMTP connection"""
+        if self._bg_tasks:
+            await asyncio.gather(*self._bg_tasks, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._smtp is not None:
+            async with self._smtp_lock:
+                await asyncio.to_thread(self._smtp_disconnect)
+
+    def _is_processed(self, file_id: str) -> bool:
+        if file_id not in self.processed_files:
+            return False
+        self.processed_files.move_to_end(file_id)
+        return True
+
+    def _mark_processed(self, file_id: str):
+        self.processed_files[file_id] = None
+        self.processed_files.move_to_end(file_id)
+        while len(self.processed_files) > Config.PROCESSED_FILES_LIMIT:
+            self.processed_files.popitem(last=False)
+
+    async def check_for_new_m3u8_files(self, old_eps: dict[str, dict[str, str | int | float]]={}) -> Optional[List[Dict[str, Any]]]:
+        results = None
         try:
-            most_recent_file = GoogleDrive.instance().get_files(M3U_QUERY, most_recent=True)[0]
+            query = M3U_QUERY
+            if self._last_seen:
+                query += f" and modifiedTime > '{self._last_seen}'"
+            files = await asyncio.to_thread(GoogleDrive.instance().get_files, query, most_recent=True)
+            if not files:
+                logger.info("No new M3U8 files since last check")
+                return
+            most_recent_file = files[0]
+            # Use Drive's own timestamp rather than the local clock to avoid missing files to skew
+            self._last_seen = most_recent_file.get('modifiedTime', self._last_seen)
                 
             file_id = most_recent_file['id']
             file_name = most_recent_file['name']
             
-            if file_id in self.processed_files:
+            if self._is_processed(file_id):
                 logger.info(f"Most recent M3U8 file '{file_name}' already processed")
                 return
                 
@@ -103,34 +143,62 @@ class AudioProcessor:
                 created_at=datetime.now(timezone.utc)
             )
             self.jobs[job_id] = job
-            self.processed_files.add(file_id)
-            results = await asyncio.create_task(self.process_m3u8_file(job_id, old_eps))
+            self._mark_processed(file_id)
+            results = await self.process_m3u8_file(job_id, old_eps)
         except Exception as e:
             logger.error(f"Error checking for new M3U8 files: {e}")
         return results
 
+    @staticmethod
+    def _is_m3u_change(change: Dict[str, Any]) -> bool:
+        file = change.get('file') or {}
+        return not change.get('removed') and not file.get('trashed') and '.m3u' in file.get('name', '')
+
     async def fallback_polling(self):
+        """
+        Poll the Drive changes feed rather than re-listing files. Each poll only returns what changed
+        since the last one, so polls start at POLL_MIN_INTERVAL and back off to POLL_INTERVAL while idle.
+        Errors back off separately, up to POLL_ERROR_BACKOFF_MAX.
+        """
         logger.info("Starting fallback polling mode...")
+        drive = GoogleDrive.instance()
+        page_token = None
+        interval = Config.POLL_MIN_INTERVAL
+        consecutive_errors = 0
         while True:
             try:
-                await self.check_for_new_m3u8_files()
-                await asyncio.sleep(Config.POLL_INTERVAL)
+                if page_token is None:
+                    # Take the token before the full check so nothing changed in between is missed
+                    page_token = await asyncio.to_thread(drive.get_start_page_token)
+                    await self.check_for_new_m3u8_files()
+                else:
+                    changes, page_token = await asyncio.to_thread(drive.get_changes, page_token)
+                    if any(self._is_m3u_change(c) for c in changes):
+                        await self.check_for_new_m3u8_files()
+                        interval = Config.POLL_MIN_INTERVAL
+                    else:
+                        interval = min(interval * 2, Config.POLL_INTERVAL)
+                consecutive_errors = 0
             except Exception as e:
-                logger.error(f"Error in fallback polling: {e}")
-                await asyncio.sleep(Config.POLL_INTERVAL)
+                # Retry transient failures quickly, backing off while they persist
+                consecutive_errors += 1
+                interval = min(Config.POLL_MIN_INTERVAL * 2 ** consecutive_errors, Config.POLL_ERROR_BACKOFF_MAX)
+                logger.error(f"Error in fallback polling, retrying in {interval}s: {e}")
+            await asyncio.sleep(interval)
 
     async def process_m3u8_file(self, job_id: str, old_eps: dict[str, dict[str, str]]={}):
         job = self.jobs[job_id]
+        # One scratch directory per job; entries name their files by uuid inside it
+        work_dir = tempfile.mkdtemp(prefix=f"playrun-{job_id}-")
         try:
             job.status = "processing"
             logger.info(f"Processing job {job_id}: {job.m3u8_file_name}")
-            m3u8_content = GoogleDrive.instance().download_file(file_id=job.m3u8_file_id)
+            m3u8_content = await asyncio.to_thread(GoogleDrive.instance().download_file, job.m3u8_file_id)
             audio_entries = self.parse_m3u8(m3u8_content)
             if not audio_entries:
                 raise Exception("No audio files found in M3U8 playlist")
             logger.info(f"Found {len(audio_entries)} audio files to process")
             
-            # Download files sequentially and start processing as each completes
             logger.info("Starting downloads and processing...")
             tasks = []
             for entry in audio_entries:
@@ -161,22 +229,11 @@ class AudioProcessor:
                     tasks.append(task)
                     continue
                 
-                temp_file = tempfile.NamedTemporaryFile(suffix='.mp3', delete=False)
-                temp_file.close()  # Close file handle but keep the file
-                
-                download_start = time.time()
-                await self.download_audio_file(entry['url'], temp_file.name)
-                download_time = time.time() - download_start
-                logger.info(f"Downloaded {entry['title']} in {download_time:.2f} seconds")
-                
-                # Add local file path to entry
-                entry['local_file'] = temp_file.name
-                
-                # Start processing immediately after download
-                task = asyncio.create_task(self.process_audio_file(entry, job.speed), name=entry['title'])
+                # Download is streamed straight into ffmpeg, so each entry is a single task
+                task = asyncio.create_task(self.process_audio_file(entry, job.speed, work_dir), name=entry['title'])
                 tasks.append(task)
 
-            logger.info(f"All downloads complete, {len(tasks)} processing tasks running...")
+            logger.info(f"{len(tasks)} processing tasks running...")
             try:
                 results = await asyncio.gather(*tasks, return_exceptions=True)
                 logger.info(f"All tasks completed, processing {len(results)} results...")
@@ -190,6 +247,18 @@ class AudioProcessor:
                     errors.append(f"File {i+1}: {str(result)}")
                 else:
                     successful_results.append(result)
+            # Grant link access to this job's uploads in one batch rather than a request per file
+            share_errors = await GoogleDrive.instance().share_files([r['drive_file_id'] for r in successful_results if 'drive_file_id' in r])
+            if share_errors:
+                # An episode nobody can download must not go in the feed; drop just those entries
+                shared_results = []
+                for result in successful_results:
+                    share_error = share_errors.get(result.get('drive_file_id'))
+                    if share_error is None:
+                        shared_results.append(result)
+                    else:
+                        errors.append(f"{result['title']}: failed to share: {share_error}")
+                successful_results = shared_results
             job.processed_files = successful_results
             if errors:
                 job.error = f"Some files failed: {'; '.join(errors)}"
@@ -198,138 +267,176 @@ class AudioProcessor:
                 job.status = "completed"
             job.completed_at = datetime.now(timezone.utc)
             # TODO not sure the value of this
-            await self.send_notification(
+            self._spawn(self.send_notification(
                 f"Job {job_id} completed. "
                 f"Successfully processed {len(successful_results)}/{len(audio_entries)} files. "
                 f"Errors: {len(errors)}"
-            )
+            ))
             logger.info(f"Job {job_id} completed with {len(successful_results)} successful files")
             return successful_results
         except Exception as e:
             job.status = "failed"
             job.error = str(e)
             job.completed_at = datetime.now(timezone.utc)
-            await self.send_notification(f"Job {job_id} failed: {str(e)}")
+            self._spawn(self.send_notification(f"Job {job_id} failed: {str(e)}"))
             logger.error(f"Job {job_id} failed: {e}")
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
 
     def parse_m3u8(self, content: str) -> List[Dict[str, Any]]:
-        lines = content.strip().split('\n')
-        entries = []
-        i = 0
-        while i < len(lines):
-            line = lines[i].strip()
-            if line.startswith('#EXTINF:'):
-                match = re.match(r'#EXTINF:([0-9.]+),(.+)', line)
-                if match:
-                    duration = float(match.group(1))
-                    title = match.group(2).strip()
-                    if i + 1 < len(lines):
-                        url = lines[i + 1].strip()
-                        if url and not url.startswith('#'):
-                            entries.append({
-                                'title': title,
-                                'duration': duration,
-                                'url': url,
-                                'uuid': str(uuid.uuid4())
-                            })
-                            i += 2
-                            continue
-            i += 1
-        return entries
+        matches = _EXTINF_RE.findall(content)
+        # One urandom call for the whole playlist rather than one per uuid4()
+        random_bytes = os.urandom(16 * len(matches))
+        return [
+            {
+                'title': title.strip(),
+                'duration': float(duration),
+                'url': url.strip(),
+                'uuid': str(uuid.UUID(bytes=random_bytes[i * 16:(i + 1) * 16], version=4))
+            }
+            for i, (duration, title, url) in enumerate(matches)
+        ]
 
     async def download_drive_file(self, file_id: str) -> str:
         try:
-            request = GoogleDrive.instance().service().files().get_media(fileId=file_id)
-            content = request.execute()
-            return content.decode('utf-8')
+            return await asyncio.to_thread(GoogleDrive.instance().download_file, file_id)
         except Exception as e:
             logger.error(f"Error downloading file {file_id}: {e}")
             raise
 
-    async def process_audio_file(self, entry: Dict[str, Any], speed: float) -> Dict[str, Any]:
+    async def process_audio_file(self, entry: Dict[str, Any], speed: float, work_dir: str) -> Dict[str, Any]:
         try:
             url = entry['url']
             title = entry['title']
             duration = entry['duration']
             file_uuid = entry['uuid']
-            local_file = entry['local_file']
             
             logger.info(f"Processing audio file: {title}")
             
-            with tempfile.NamedTemporaryFile(suffix='.mp3', delete=False) as temp_output:
-                ffmpeg_start = time.time()
-                await self.process_audio_with_ffmpeg(local_file, temp_output.name, speed)
-                ffmpeg_time = time.time() - ffmpeg_start
-                logger.info(f"FFmpeg processed {title} in {ffmpeg_time:.2f} seconds")
-                
-                new_duration = int(duration / speed)
-                
-                # Clean up input file
-                os.unlink(local_file)
-                
-                return {
-                    'title': title,
-                    'original_url': url,
-                    'original_duration': duration,
-                    'new_duration': new_duration,
-                    'uuid': file_uuid,
-                    'speed': speed,
-                    'temp_file': temp_output.name,
-                }
+            output_path = os.path.join(work_dir, f"{file_uuid}.mp3")
+            async with self._scratch_sem:
+                try:
+                    ffmpeg_start = time.time()
+                    await self.process_audio_with_ffmpeg(url, output_path, speed)
+                    ffmpeg_time = time.time() - ffmpeg_start
+                    logger.info(f"Downloaded and processed {title} in {ffmpeg_time:.2f} seconds")
+
+                    # Upload as soon as this entry is encoded rather than after the whole playlist
+                    async with self._upload_sem:
+                        logger.info(f"Uploading {title} to Google Drive")
+                        drive_file_id = await GoogleDrive.instance().upload_to_drive(output_path, f"{title}.mp3", share=False)
+                finally:
+                    # Free disk as soon as the entry is done; the job's rmtree catches anything left
+                    if os.path.exists(output_path):
+                        os.unlink(output_path)
+
+            new_duration = int(duration / speed)
+
+            return {
+                'title': title,
+                'original_url': url,
+                'original_duration': duration,
+                'new_duration': new_duration,
+                'uuid': file_uuid,
+                'speed': speed,
+                'drive_file_id': drive_file_id,
+            }
         except Exception as e:
             logger.error(f"Error processing audio file {title}: {e}")
-            # Clean up input file on error
-            if 'local_file' in entry and os.path.exists(entry['local_file']):
-                os.unlink(entry['local_file'])
             raise
 
-    async def download_audio_file(self, url: str, output_path: str):
+    async def download_audio_file(self, url: str, sink: asyncio.StreamWriter):
+        """Stream the audio at url into sink, closing it once the body is exhausted"""
         logger.info(f"Downloading audio from: {url}")
-        timeout = aiohttp.ClientTimeout(total=None, connect=15, sock_read=10)
         try:
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(url) as response:
-                    if response.status == 200:
-                        with open(output_path, 'wb') as f:
-                            async for chunk in response.content.iter_chunked(8192):
-                                f.write(chunk)
-                    else:
-                        raise Exception(f"Failed to download audio file: HTTP {response.status}")
+            async with self._session.get(url) as response:
+                if response.status == 200:
+                    async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        sink.write(chunk)
+                        await sink.drain()
+                else:
+                    raise Exception(f"Failed to download audio file: HTTP {response.status}")
         except asyncio.TimeoutError as e:
             raise Exception(f"Download timeout for {url}: Connection timeout or no data received for 10 seconds")
         except Exception as e:
             # Re-raise other exceptions as-is
             raise
+        finally:
+            sink.close()
 
-    async def process_audio_with_ffmpeg(self, input_path: str, output_path: str, speed: float):
+    async def process_audio_with_ffmpeg(self, url: str, output_path: str, speed: float):
         try:
             cmd = [
                 'ffmpeg',
-                '-i', input_path,
+                '-hide_banner',
+                '-loglevel', 'error',
+                '-i', 'pipe:0',
                 # '-t', '10',
+                # Drop embedded cover art so it isn't re-encoded as a video stream
+                '-vn',
                 '-filter:a', f'atempo={speed}',
+                # Parallelism comes from running MAX_WORKERS encodes at once, not threads within one
+                '-threads', '1',
+                '-filter_threads', '1',
                 '-y',
                 output_path
             ]
             
             logger.info(f"Starting FFmpeg processing with {speed}x speed...")
             
-            # Use async subprocess instead of blocking subprocess.run()
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            stdout, stderr = await process.communicate()
+            # Cap concurrent encodes so a large playlist doesn't oversubscribe the CPU
+            async with self._ffmpeg_sem:
+                process = await asyncio.create_subprocess_exec(
+                    *cmd,
+                    stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.PIPE
+                )
+                # stderr must be drained while feeding stdin or ffmpeg stalls on a full pipe
+                download, stderr = await asyncio.gather(
+                    self.download_audio_file(url, process.stdin),
+                    process.stderr.read(),
+                    return_exceptions=True
+                )
+                await process.wait()
             
+            # A failed download leaves ffmpeg with truncated input, so report the download's own error.
+            # A broken pipe means ffmpeg exited first and its stderr explains why.
+            if isinstance(download, Exception) and not isinstance(download, (BrokenPipeError, ConnectionResetError)):
+                raise download
             if process.returncode != 0:
-                stderr_text = stderr.decode() if stderr else "Unknown error"
+                stderr_text = stderr.decode() if isinstance(stderr, bytes) and stderr else "Unknown error"
                 raise Exception(f"FFmpeg error (code {process.returncode}): {stderr_text}")
+            if isinstance(download, Exception):
+                raise download
         except Exception as e:
             logger.error(f"Error processing audio with FFmpeg: {e}")
             raise
 
+    def _smtp_connect(self):
+        server = smtplib.SMTP(Config.SMTP_SERVER, Config.SMTP_PORT)
+        server.starttls()
+        server.login(Config.EMAIL_USERNAME, Config.EMAIL_PASSWORD)
+        self._smtp = server
+
+    def _smtp_disconnect(self):
+        try:
+            self._smtp.quit()
+        except smtplib.SMTPException:
+            self._smtp.close()
+        finally:
+            self._smtp = None
+
+    def _smtp_send(self, msg: MIMEMultipart):
+        """Send over the persistent SMTP connection, reconnecting once if the server dropped it"""
+        if self._smtp is None:
+            self._smtp_connect()
+        try:
+            self._smtp.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            self._smtp_connect()
+            self._smtp.send_message(msg)
+
     async def send_notification(self, message: str):
         if not all([Config.EMAIL_USERNAME, Config.EMAIL_PASSWORD, Config.NOTIFICATION_EMAIL]):
             logger.warning("Email configuration not complete, skipping notification")
@@ -340,14 +447,15 @@ class AudioProcessor:
             msg['To'] = Config.NOTIFICATION_EMAIL
             msg['Subject'] = "M3U8 Audio Processor Notification"
             msg.attach(MIMEText(message, 'plain'))
-            server = smtplib.SMTP(Config.SMTP_SERVER, Config.SMTP_PORT)
-            server.starttls()
-            server.login(Config.EMAIL_USERNAME, Config.EMAIL_PASSWORD)
-            server.send_message(msg)
-            server.quit()
+            async with self._smtp_lock:
+                await asyncio.to_thread(self._smtp_send, msg)
             logger.info("Notification sent successfully")
         except Exception as e:
             logger.error(f"Error sending notification: {e}")
+            # Don't reuse a connection left in an unknown state
+            if self._smtp is not None:
+                self._smtp.close()
+                self._smtp = None
 
     def get_job_status(self, job_id: str) -> Optional[ProcessingJob]:
         return self.jobs.get(job_id)
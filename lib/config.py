@@ -12,9 +12,14 @@ class Config:
     WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', str(uuid.uuid4()))
     DEFAULT_SPEED = 1.5
     MAX_WORKERS = max(1, multiprocessing.cpu_count() - 1)
+    UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', '4'))
+    IO_WORKERS = int(os.getenv('IO_WORKERS', '32'))
     SMTP_SERVER = os.getenv('SMTP_SERVER', 'smtp.gmail.com')
     SMTP_PORT = int(os.getenv('SMTP_PORT', '587'))
     EMAIL_USERNAME = os.getenv('EMAIL_USERNAME')
     EMAIL_PASSWORD = os.getenv('EMAIL_PASSWORD')
     NOTIFICATION_EMAIL = os.getenv('NOTIFICATION_EMAIL')
     POLL_INTERVAL = int(os.getenv('POLL_INTERVAL', '300'))
+    POLL_MIN_INTERVAL = int(os.getenv('POLL_MIN_INTERVAL', '5'))
+    POLL_ERROR_BACKOFF_MAX = int(os.getenv('POLL_ERROR_BACKOFF_MAX', '60'))
+    PROCESSED_FILES_LIMIT = int(os.getenv('PROCESSED_FILES_LIMIT', '10000'))
@@ -1,14 +1,40 @@
+import asyncio
 import io
 import logging
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
 from google.auth import default
+from google_auth_httplib2 import AuthorizedHttp, Request
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload
+from googleapiclient.errors import HttpError
+from googleapiclient.http import build_http, MediaFileUpload, MediaIoBaseUpload, MediaIoBaseDownload
 from .config import Config
 
 logger = logging.getLogger(__name__)
 
+PUBLIC_PERMISSION = {
+    'type': 'anyone',
+    'role': 'reader'
+}
+# Drive rejects batch requests with more than 100 calls
+BATCH_LIMIT = 100
+# Attempts at granting link access before giving up on a file
+SHARE_RETRIES = 5
+# Large enough that playlists and feeds arrive in one request, small enough to bound big ones
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Resumable upload chunk; must be a multiple of 256 KiB
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+_DL_TEMPLATE = "https://drive.usercontent.google.com/download?id=%s&export=download&authuser=0&confirm=t"
+# Matches the file ID in download URLs as well as /file/d/<id> share links
+_DRIVE_ID_RE = re.compile(r'(?:[?&]id=|/file/d/|/d/)([a-zA-Z0-9_-]+)')
+
 class GoogleDrive:
     _instance = None
+    _local = threading.local()
+    _init_lock = threading.Lock()
+    _refresh_lock = threading.Lock()
 
     def __new__(cls):
         raise RuntimeError("Use GoogleDrive.get_instance() instead of GoogleDrive()")
@@ -21,18 +47,28 @@ class GoogleDrive:
 
     @classmethod
     def instance(cls):
-        if cls._instance is None:
-            try:
-                credentials, project_id = default(scopes=Config.SCOPES)
-                if not Config.PROJECT_ID:
-                    Config.PROJECT_ID = project_id
-                cls.drive_service = build('drive', 'v3', credentials=credentials)
-                logger.info(f"Google services initialized with project: {Config.PROJECT_ID}")
-            except Exception as e:
-                logger.error(f"Failed to initialize Google services: {e}")
-                logger.info("Make sure you've run 'gcloud auth application-default login'")
-                raise
-            cls._instance = object.__new__(cls)
+        # Fast path stays lock-free once initialized; the lock only serializes first-time setup
+        if cls._instance is not None:
+            return cls._instance
+        with cls._init_lock:
+            if cls._instance is None:
+                try:
+                    credentials, project_id = default(scopes=Config.SCOPES)
+                    if not Config.PROJECT_ID:
+                        Config.PROJECT_ID = project_id
+                    cls.credentials = credentials
+                    # Use the discovery document bundled with the client rather than fetching it at startup
+                    cls.drive_service = build('drive', 'v3', credentials=credentials, static_discovery=True, cache_discovery=False)
+                    # Each resource accessor builds a new proxy from the discovery document, so bind them once
+                    cls._files = cls.drive_service.files()
+                    cls._permissions = cls.drive_service.permissions()
+                    cls._changes = cls.drive_service.changes()
+                    logger.info(f"Google services initialized with project: {Config.PROJECT_ID}")
+                except Exception as e:
+                    logger.error(f"Failed to initialize Google services: {e}")
+                    logger.info("Make sure you've run 'gcloud auth application-default login'")
+                    raise
+                cls._instance = object.__new__(cls)
         return cls._instance
 
     @classmethod
@@ -46,39 +82,177 @@ class GoogleDrive:
         Returns:
             Direct download URL in the format required
         """
-        return f"https://drive.usercontent.google.com/download?id={drive_id}&export=download&authuser=0&confirm=t"
+        return _DL_TEMPLATE % drive_id
+
+    @classmethod
+    def extract_drive_id(cls, drive_url: str) -> Optional[str]:
+        """
+        Get the Google Drive file ID back out of a download or share URL.
+        
+        Args:
+            drive_url: URL such as one returned by generate_download_url()
+            
+        Returns:
+            The file ID, or None if the URL does not contain one
+        """
+        match = _DRIVE_ID_RE.search(drive_url)
+        return match.group(1) if match else None
+
 
+    def _http(self) -> AuthorizedHttp:
+        """
+        httplib2 is not thread safe, so each worker thread gets its own authorized connection.
+        build_http() sets it up the way build() would: with a socket timeout, and not
+        following the 308s Drive answers resumable upload chunks with.
+        """
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = AuthorizedHttp(self.credentials, http=build_http())
+            self._local.http = http
+        self._refresh_credentials(http)
+        return http
+
+    def _refresh_credentials(self, http: AuthorizedHttp):
+        """
+        The credentials are shared by every thread's connection, so refresh them under a lock.
+        Otherwise concurrent uploads that find the token expired would each hit the token endpoint.
+        """
+        if self.credentials.valid:
+            return
+        with self._refresh_lock:
+            if not self.credentials.valid:
+                logger.info("Refreshing Google credentials")
+                self.credentials.refresh(Request(http.http))
+
+    def _execute(self, request):
+        """Execute an API request on this thread's connection"""
+        return request.execute(http=self._http())
+
+    def _execute_resumable(self, request):
+        """Send a resumable upload chunk by chunk, continuing from wherever a previous attempt stopped"""
+        # Drive acknowledges each unfinished chunk with 308 Resume Incomplete, so this only works
+        # on connections from _http(), which don't treat 308 as a redirect
+        http = self._http()
+        response = None
+        while response is None:
+            _, response = request.next_chunk(http=http)
+        return response
 
     def _set_file_permissions(self, file_id: str, filename: str):
         """Set file permissions to be readable by anyone with the link"""
-        permission = {
-            'type': 'anyone',
-            'role': 'reader'
-        }
         logger.info(f"Setting permissions for {filename} (ID: {file_id})")
-        self.drive_service.permissions().create(
+        self._execute(self._permissions.create(
             fileId=file_id,
-            body=permission
-        ).execute()
+            body=PUBLIC_PERMISSION
+        ))
+
+    @staticmethod
+    def _is_retryable(exception: Exception) -> bool:
+        """Whether a failed request is worth retrying: rate limits, server errors and transport failures"""
+        if not isinstance(exception, HttpError):
+            return True
+        status = exception.resp.status
+        if status == 429 or status >= 500:
+            return True
+        # Drive reports rateLimitExceeded, userRateLimitExceeded and sharingRateLimitExceeded as 403s
+        return status == 403 and b'ratelimitexceeded' in (exception.content or b'').lower()
+
+    def _set_files_permissions(self, file_ids: List[str]) -> Dict[str, Exception]:
+        """
+        Set several files readable by anyone with the link using batched requests.
+        Failed grants are retried with backoff; whatever still fails is returned by file ID.
+        """
+        failures: Dict[str, Exception] = {}
+        given_up: Dict[str, Exception] = {}
+
+        def callback(request_id, response, exception):
+            if exception is not None:
+                failures[request_id] = exception
+
+        pending = list(file_ids)
+        for attempt in range(SHARE_RETRIES):
+            if attempt:
+                delay = 2 ** (attempt - 1)
+                logger.warning(f"Retrying permissions for {len(pending)} files in {delay}s")
+                time.sleep(delay)
+            failures.clear()
+            for start in range(0, len(pending), BATCH_LIMIT):
+                chunk = pending[start:start + BATCH_LIMIT]
+                batch = self.drive_service.new_batch_http_request(callback=callback)
+                for file_id in chunk:
+                    batch.add(self._permissions.create(
+                        fileId=file_id,
+                        body=PUBLIC_PERMISSION
+                    ), request_id=file_id)
+                try:
+                    batch.execute(http=self._http())
+                except Exception as e:
+                    # The whole batch failed to go through, so every grant in it did
+                    for file_id in chunk:
+                        failures.setdefault(file_id, e)
+            pending = []
+            for file_id, e in failures.items():
+                if self._is_retryable(e):
+                    pending.append(file_id)
+                else:
+                    given_up[file_id] = e
+            if not pending:
+                break
+        # Anything still pending ran out of attempts
+        given_up.update((file_id, failures[file_id]) for file_id in pending)
+        return given_up
+
+    async def share_files(self, file_ids: List[str]) -> Dict[str, str]:
+        """
+        Make previously uploaded files readable by anyone with the link.
+
+        Returns:
+            The error for each file that could not be shared, keyed by file ID
+        """
+        if not file_ids:
+            return {}
+        logger.info(f"Setting permissions for {len(file_ids)} files")
+        try:
+            failures = await asyncio.to_thread(self._set_files_permissions, file_ids)
+        except Exception as e:
+            logger.error(f"Error setting permissions on Google Drive: {e}")
+            raise
+        for file_id, e in failures.items():
+            logger.error(f"Error setting permissions for {file_id} on Google Drive: {e}")
+        return {file_id: str(e) for file_id, e in failures.items()}
+
+    async def upload_to_drive(self, file_path: str, filename: str, mimetype='audio/mpeg', share: bool = True) -> str:
+        """
+        Upload a local file to Google Drive.
+
+        Args:
+            file_path: Path of the file to upload
+            filename: Name to give the file in Drive
+            mimetype: MIME type of the file
+            share: Make the file readable by anyone with the link. Pass False to
+                grant access later for many files at once with share_files().
 
-    async def upload_to_drive(self, file_path: str, filename: str, mimetype='audio/mpeg') -> str:
+        Returns:
+            The Drive file ID
+        """
         try:
             file_metadata = {
                 'name': filename,
                 'parents': []
             }
-            media = MediaFileUpload(file_path, mimetype)
+            media = MediaFileUpload(file_path, mimetype, chunksize=UPLOAD_CHUNK_SIZE, resumable=True)
+            request = self._files.create(
+                body=file_metadata,
+                media_body=media,
+                fields='id'
+            )
             logger.info(f"Uploading {file_path} ({filename})")
             
-            # Retry logic for file creation
+            # Retry logic for file creation; retries resume the same upload session
             max_retries = 5
             for attempt in range(max_retries):
                 try:
-                    file = self.drive_service.files().create(
-                        body=file_metadata,
-                        media_body=media,
-                        fields='id'
-                    ).execute()
+                    file = await asyncio.to_thread(self._execute_resumable, request)
                     break
                 except Exception as e:
                     if attempt == max_retries - 1:
@@ -88,7 +262,8 @@ class GoogleDrive:
             file_id = file.get('id')
             logger.info(f"File uploaded successfully: {filename} (ID: {file_id})")
             
-            self._set_file_permissions(file_id, filename)
+            if share:
+                await asyncio.to_thread(self._set_file_permissions, file_id, filename)
             return file_id
         except Exception as e:
             logger.error(f"Error {filename} uploading to Google Drive: {e}")
@@ -105,27 +280,23 @@ class GoogleDrive:
                           resumable=True)
             if file_id:
                 # Update existing file
-                file = self.drive_service.files().update(
+                request = self._files.update(
                     fileId=file_id,
                     body=file_metadata,
                     media_body=media,
                     fields='id'
-                ).execute()
+                )
             else:
-                file = self.drive_service.files().create(
+                request = self._files.create(
                     body=file_metadata,
                     media_body=media,
                     fields='id'
-                ).execute()
-            file_id = file.get('id')
-            permission = {
-                'type': 'anyone',
-                'role': 'reader'
-            }
-            self.drive_service.permissions().create(
-                fileId=file_id,
-                body=permission
-            ).execute()
+                )
+            file = await asyncio.to_thread(self._execute, request)
+            if not file_id:
+                file_id = file.get('id')
+            # Grant on updates too, so a file that was created by hand or lost its link access is shared again
+            await asyncio.to_thread(self._set_file_permissions, file_id, filename)
             return file_id
         except Exception as e:
             logger.error(f"Error uploading string to Google Drive: {e}")
@@ -135,23 +306,69 @@ class GoogleDrive:
         orderBy = 'modifiedTime desc' if most_recent else None
         pageSize = 1 if most_recent else None
         try:
-            results = GoogleDrive.instance().drive_service.files().list(
+            results = self._execute(self._files.list(
                 q=query,
                 orderBy=orderBy,
                 pageSize=pageSize,
                 fields="files(id, name, modifiedTime)"
-            ).execute()
+            ))
             return results.get('files', [])
         except Exception as e:
             logger.error(f"Error searching for existing RSS file: {e}")
             raise
 
-    def download_file(self, file_id: str) -> str:
-        """Download a file and return as string (for text files)"""
+    def get_start_page_token(self) -> str:
+        """Get a token marking the current position in the Drive changes feed"""
         try:
-            request = self.drive_service.files().get_media(fileId=file_id)
-            content = request.execute()
+            response = self._execute(self._changes.getStartPageToken())
+            return response['startPageToken']
         except Exception as e:
-            logger.error(f"Error downloading file {file_id} to string: {e}")
+            logger.error(f"Error getting Drive changes start token: {e}")
             raise
-        return content.decode('utf-8')
\ No newline at end of file
+
+    def get_changes(self, page_token: str) -> Tuple[List[Dict[str, Any]], str]:
+        """
+        List changes to Drive since page_token.
+
+        Args:
+            page_token: Token from get_start_page_token() or a previous call
+
+        Returns:
+            The changed files and the token to pass on the next call
+        """
+        changes = []
+        try:
+            while True:
+                response = self._execute(self._changes.list(
+                    pageToken=page_token,
+                    fields="nextPageToken, newStartPageToken, changes(fileId, removed, file(id, name, modifiedTime, trashed))"
+                ))
+                changes.extend(response.get('changes', []))
+                if 'newStartPageToken' in response:
+                    return changes, response['newStartPageToken']
+                page_token = response['nextPageToken']
+        except Exception as e:
+            logger.error(f"Error listing Drive changes: {e}")
+            raise
+
+    def download_file_stream(self, file_id: str) -> io.BytesIO:
+        """Download a file into memory and return it as a binary stream positioned at the start"""
+        try:
+            request = self._files.get_media(fileId=file_id)
+            request.http = self._http()
+            buffer = io.BytesIO()
+            downloader = MediaIoBaseDownload(buffer, request, chunksize=DOWNLOAD_CHUNK_SIZE)
+            done = False
+            while not done:
+                _, done = downloader.next_chunk()
+        except Exception as e:
+            logger.error(f"Error downloading file {file_id}: {e}")
+            raise
+        buffer.seek(0)
+        return buffer
+
+    def download_file(self, file_id: str) -> str:
+        """Download a file and return as string (for text files)"""
+        buffer = self.download_file_stream(file_id)
+        # Decode straight from the buffer instead of copying it out with getvalue() first
+        return str(buffer.getbuffer(), 'utf-8')
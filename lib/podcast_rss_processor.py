@@ -4,10 +4,13 @@ Podcast RSS Processor
 Generates podcast RSS XML files from processed audio files.
 """
 
+import io
+import os
 import xml.etree.ElementTree as ET
 from datetime import datetime, timezone
 from typing import Dict, List, Any
 import logging
+from xml.sax.saxutils import escape
 from .gdrive import GoogleDrive
 
 logger = logging.getLogger(__name__)
@@ -18,6 +21,54 @@ NAMESPACES = {
     'playrunaddict': 'http://playrunaddict.com/rss/1.0',
     'itunes': 'http://www.itunes.com/dtds/podcast-1.0.dtd'
 }
+# Keep the feed's own prefixes when re-serializing parsed XML instead of ns0, ns1...
+for _prefix, _uri in NAMESPACES.items():
+    ET.register_namespace(_prefix, _uri)
+
+# Clark-notation name, so per-item lookups skip ElementTree's prefix expansion
+_ORIGINAL_DURATION_TAG = '{%s}originalduration' % NAMESPACES['playrunaddict']
+
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>\n'
+
+# Same escaping ElementTree applies when serializing attribute values
+_ATTR_ENTITIES = {'"': '&quot;', '\n': '&#10;', '\r': '&#13;', '\t': '&#09;'}
+
+def _escape_text(value: Any) -> str:
+    return '' if value is None else escape(str(value))
+
+def _escape_attr(value: Any) -> str:
+    return '' if value is None else escape(str(value), _ATTR_ENTITIES)
+
+# Everything in the channel header but the per-feed values is fixed, so lay it out once
+_CHANNEL_HEADER_TEMPLATE = (
+    XML_DECLARATION +
+    '<rss version="2.0" xmlns:itunes="http://www.itunes.com/dtds/podcast-1.0.dtd" '
+    'xmlns:playrunaddict="http://playrunaddict.com/rss/1.0">'
+    '<channel>'
+    '<title>{title}</title>'
+    '<description>{description}</description>'
+    '<link>{link}</link>'
+    '<language>en-us</language>'
+    '<lastBuildDate>{build_date}</lastBuildDate>'
+    # iTunes specific tags
+    '<itunes:author>Playrun Addict</itunes:author>'
+    '<itunes:summary>{description}</itunes:summary>'
+    '<itunes:category text="Technology" />'
+    '<itunes:explicit>false</itunes:explicit>'
+)
+
+# iterparse() reads its source 16 KiB at a time; feeds are already fully in memory, so hand expat bigger slices
+PARSE_CHUNK_SIZE = 64 * 1024
+
+def _iterparse_buffer(stream: io.BytesIO):
+    """Like ET.iterparse(stream, events=('start', 'end')), feeding the parser straight from the stream's buffer"""
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    with stream.getbuffer() as data:
+        for offset in range(0, len(data), PARSE_CHUNK_SIZE):
+            parser.feed(data[offset:offset + PARSE_CHUNK_SIZE])
+            yield from parser.read_events()
+    parser.close()
+    yield from parser.read_events()
 
 class PodcastRSSProcessor:
     """
@@ -41,94 +92,66 @@ class PodcastRSSProcessor:
         Returns:
             RSS XML as a string
         """
-        # Create root RSS element
-        rss = ET.Element("rss")
-        rss.set("version", "2.0")
-        rss.set("xmlns:itunes", "http://www.itunes.com/dtds/podcast-1.0.dtd")
-        rss.set("xmlns:playrunaddict", "http://playrunaddict.com/rss/1.0")
-        
-        # Create channel element
-        channel = ET.SubElement(rss, "channel")
-        
-        # Add channel metadata
-        title_elem = ET.SubElement(channel, "title")
-        title_elem.text = self.channel_title
-        
-        description_elem = ET.SubElement(channel, "description")
-        description_elem.text = feed_description
-        
-        link_elem = ET.SubElement(channel, "link")
-        link_elem.text = feed_link
-        
-        language_elem = ET.SubElement(channel, "language")
-        language_elem.text = "en-us"
-        
-        # Add build date
-        last_build_date = ET.SubElement(channel, "lastBuildDate")
-        last_build_date.text = datetime.now(timezone.utc).strftime("%a, %d %b %Y %H:%M:%S %z")
-        
-        # Add iTunes specific tags
-        itunes_author = ET.SubElement(channel, "itunes:author")
-        itunes_author.text = "Playrun Addict"
-        
-        itunes_summary = ET.SubElement(channel, "itunes:summary")
-        itunes_summary.text = feed_description
-        
-        itunes_category = ET.SubElement(channel, "itunes:category")
-        itunes_category.set("text", "Technology")
-        
-        itunes_explicit = ET.SubElement(channel, "itunes:explicit")
-        itunes_explicit.text = "false"
+        return ''.join(self._iter_rss_parts(processed_files, feed_description, feed_link))
+    
+    def _iter_rss_parts(self, processed_files: List[Dict[str, Any]], feed_description: str, feed_link: str):
+        """
+        Yield the RSS XML for processed files as a sequence of string fragments,
+        one item at a time, so callers can write it out without holding the whole feed.
+        """
+        # The feed is write-only with a fixed schema, so assemble the markup directly
+        # rather than building an element tree just to serialize it once
+        parts = [_CHANNEL_HEADER_TEMPLATE.format(
+            title=_escape_text(self.channel_title),
+            description=_escape_text(feed_description),
+            link=_escape_text(feed_link),
+            build_date=datetime.now(timezone.utc).strftime("%a, %d %b %Y %H:%M:%S %z"),
+        )]
+        yield from parts
         
         # Add items for each processed file
         for file_data in processed_files:
-            self._add_item_to_channel(channel, file_data)
+            parts.clear()
+            self._add_item_to_channel(parts, file_data)
+            yield from parts
         
-        # Convert to string with proper XML declaration
-        xml_str = ET.tostring(rss, encoding='unicode')
-        return f'<?xml version="1.0" encoding="UTF-8"?>\n{xml_str}'
+        yield '</channel></rss>'
     
-    def _add_item_to_channel(self, channel: ET.Element, file_data: Dict[str, Any]):
+    def _add_item_to_channel(self, parts: List[str], file_data: Dict[str, Any]):
         """
-        Add an item element to the channel for a processed file.
+        Append the markup for an item in the channel for a processed file.
         
         Args:
-            channel: The channel XML element
+            parts: The list of XML fragments making up the feed
             file_data: Dictionary containing processed file information
         """
-        item = ET.SubElement(channel, "item")
-        
-        # Title
-        title = ET.SubElement(item, "title")
-        title.text = file_data.get('title', 'Untitled Episode')
-        
-        # GUID
-        guid = ET.SubElement(item, "guid")
-        guid.text = file_data.get('original_guid') or file_data.get('uuid', f"episode-{hash(file_data.get('title', ''))}")
-        guid.set("isPermaLink", "false")
-
-        # Original duration (custom namespace)
-        original_duration = ET.SubElement(item, "playrunaddict:originalduration")
-        original_duration.text = str(file_data.get('original_duration', 0))
-        
-        # Enclosure (the actual audio file)
-        enclosure = ET.SubElement(item, "enclosure")
-        
+        title = file_data.get('title', 'Untitled Episode')
+        guid = file_data.get('original_guid')
+        if not guid:
+            # Only hash the title when there is no uuid to fall back on
+            guid = file_data['uuid'] if 'uuid' in file_data else f"episode-{hash(file_data.get('title', ''))}"
+        original_duration = file_data.get('original_duration', 0)
         download_url = file_data.get('download_url') or GoogleDrive.generate_download_url(file_data['drive_file_id'])
-        enclosure.set("url", download_url)
-        
-        # Set enclosure type (MIME type)
-        enclosure.set("type", "audio/mpeg")
         
         # Set length (duration in seconds, or file size if available)
         duration = file_data.get('new_duration', file_data.get('duration', 0))
         if isinstance(duration, (int, float)):
             # If we have duration, use it (RSS length is typically file size in bytes, 
             # but for podcasts, duration in seconds is also acceptable)
-            enclosure.set("length", str(int(duration)))
+            length = str(int(duration))
         else:
             # Default length if not available
-            enclosure.set("length", "0")
+            length = "0"
+        
+        parts.append(
+            f'<item><title>{_escape_text(title)}</title>'
+            f'<guid isPermaLink="false">{_escape_text(guid)}</guid>'
+        )
+        # Readers treat a missing original duration as 0, so don't spend bytes on the default.
+        # The enclosure length stays even when 0 since RSS requires the attribute.
+        if original_duration:
+            parts.append(f'<playrunaddict:originalduration>{_escape_text(str(original_duration))}</playrunaddict:originalduration>')
+        parts.append(f'<enclosure url="{_escape_attr(download_url)}" type="audio/mpeg" length="{length}" /></item>')
     
     def save_rss_to_file(self, processed_files: List[Dict[str, Any]], 
                          output_path: str,
@@ -143,10 +166,19 @@ class PodcastRSSProcessor:
             feed_description: Description for the RSS feed
             feed_link: Link for the RSS feed
         """
-        rss_xml = self.create_rss_xml(processed_files, feed_description, feed_link)
-        
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write(rss_xml)
+        # Write alongside and swap in, so a crash never leaves a truncated feed behind
+        tmp_path = f"{output_path}.tmp.{os.getpid()}"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                # Stream the feed out item by item instead of joining it into one string first
+                f.writelines(self._iter_rss_parts(processed_files, feed_description, feed_link))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, output_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
         
         logger.info(f"RSS feed saved to {output_path}")
     
@@ -161,12 +193,16 @@ class PodcastRSSProcessor:
             Formatted XML string
         """
         try:
-            import xml.dom.minidom as minidom
-            dom = minidom.parseString(xml_string)
-            return dom.toprettyxml(indent="  ")
+            # lxml pretty-prints in C
+            import lxml.etree as LET
+            root = LET.fromstring(xml_string.encode('utf-8'))
+            return XML_DECLARATION + LET.tostring(root, encoding='unicode', pretty_print=True)
         except ImportError:
-            # Fallback if minidom is not available
-            return xml_string
+            pass
+        # ET.indent works on the element tree directly, no DOM round-trip needed
+        root = ET.fromstring(xml_string)
+        ET.indent(root, space="  ")
+        return XML_DECLARATION + ET.tostring(root, encoding='unicode')
 
     def get_rss_feed_id(self):
         files = GoogleDrive.instance().get_files(RSS_QUERY, most_recent=True)
@@ -195,6 +231,48 @@ class PodcastRSSProcessor:
             logger.error(f"Error downloading and parsing RSS feed file {file_id}: {e}")
             raise
 
+    def stream_episode_mapping(self, file_id: str) -> Dict[str, Dict[str, str]]:
+        """
+        Download the RSS feed file from Google Drive and extract its episode mapping
+        in a single streaming pass, freeing each item as soon as it has been read.
+        
+        Args:
+            file_id: The ID of the RSS feed file
+            
+        Returns:
+            Dictionary mapping episode titles to their download info, as returned
+            by extract_episode_mapping()
+        """
+        episode_mapping = {}
+        
+        try:
+            stream = GoogleDrive.instance().download_file_stream(file_id)
+            # Track the open element path so only <item>s directly under the channel count
+            path = []
+            channel = None
+            for event, elem in _iterparse_buffer(stream):
+                if event == 'start':
+                    path.append(elem.tag)
+                    if len(path) == 2 and elem.tag == 'channel' and channel is None:
+                        channel = elem
+                    continue
+                
+                if len(path) == 3 and elem.tag == 'item' and channel is not None and path[1] == 'channel':
+                    self._add_item_to_mapping(episode_mapping, elem)
+                    # Drop the parsed item so the tree never holds more than one at a time
+                    elem.clear()
+                    channel.remove(elem)
+                path.pop()
+            
+            if channel is None:
+                logger.warning("No channel element found in RSS XML")
+            logger.info(f"Successfully extracted {len(episode_mapping)} episode mappings from RSS feed {file_id}")
+            return episode_mapping
+            
+        except Exception as e:
+            logger.error(f"Error streaming episode mapping from RSS feed file {file_id}: {e}")
+            raise
+
     def extract_episode_mapping(self, root: ET.Element) -> Dict[str, Dict[str, str]]:
         """
         Extract episode mapping from RSS XML root element.
@@ -225,36 +303,46 @@ class PodcastRSSProcessor:
             logger.info(f"Found {len(items)} episodes in RSS feed")
             
             for item in items:
-                # Get title
-                title_elem = item.find('title')
-                title = title_elem.text if title_elem is not None and title_elem.text else "Untitled Episode"
-
-                guid_elem = item.find('guid')
-                guid = guid_elem.text if guid_elem is not None and guid_elem.text else None
-
-                # Get original duration from custom namespace
-                original_duration_elem = item.find('playrunaddict:originalduration', NAMESPACES)
-                original_duration = original_duration_elem.text if original_duration_elem is not None and original_duration_elem.text else "0"
-                
-                # Get enclosure info
-                enclosure = item.find('enclosure')
-                if enclosure is not None:
-                    download_url = enclosure.get('url', '')
-                    length = enclosure.get('length', '0')
-                    
-                    episode_mapping[title] = {
-                        'download_url': download_url,
-                        'length': length,
-                        'original_duration': original_duration
-                    }
-                    if guid:
-                        episode_mapping[title]['original_guid'] = guid
-                else:
-                    logger.warning(f"No enclosure found for episode: {title}")
+                self._add_item_to_mapping(episode_mapping, item)
             
             logger.info(f"Successfully extracted {len(episode_mapping)} episode mappings")
             return episode_mapping
             
         except Exception as e:
             logger.error(f"Error extracting episode mapping from RSS XML: {e}")
-            raise
\ No newline at end of file
+            raise
+
+    def _add_item_to_mapping(self, episode_mapping: Dict[str, Dict[str, str]], item: ET.Element):
+        """
+        Add the download info for an RSS item element to the episode mapping.
+        
+        Args:
+            episode_mapping: The mapping being built
+            item: The item XML element
+        """
+        # Get title
+        title_elem = item.find('title')
+        title = title_elem.text if title_elem is not None and title_elem.text else "Untitled Episode"
+
+        guid_elem = item.find('guid')
+        guid = guid_elem.text if guid_elem is not None and guid_elem.text else None
+
+        # Get original duration from custom namespace
+        original_duration_elem = item.find(_ORIGINAL_DURATION_TAG)
+        original_duration = original_duration_elem.text if original_duration_elem is not None and original_duration_elem.text else "0"
+        
+        # Get enclosure info
+        enclosure = item.find('enclosure')
+        if enclosure is not None:
+            download_url = enclosure.get('url', '')
+            length = enclosure.get('length', '0')
+            
+            episode_mapping[title] = {
+                'download_url': download_url,
+                'length': length,
+                'original_duration': original_duration
+            }
+            if guid:
+                episode_mapping[title]['original_guid'] = guid
+        else:
+            logger.warning(f"No enclosure found for episode: {title}")
@@ -6,37 +6,7 @@ uploads to cloud storage, and pushes to Playrun API.
 """
 
 import asyncio
-import json
 import logging
-import os
-from platform import processor
-import tempfile
-import time
-import uuid
-from concurrent.futures import ThreadPoolExecutor
-from datetime import datetime, timezone
-from pathlib import Path
-from typing import Dict, List, Optional, Any
-from urllib.parse import urlparse
-import hashlib
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-
-import aiohttp
-import requests
-from fastapi import FastAPI, HTTPException, BackgroundTasks, Request
-from fastapi.responses import JSONResponse
-from google.auth import default
-from google.cloud import pubsub_v1
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
-import subprocess
-import multiprocessing
-from pydantic import BaseModel
-import re
-import hmac
-import base64
 
 # Configure logging
 logging.basicConfig(
@@ -45,25 +15,30 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-import asyncio
 from lib.audio_processor import AudioProcessor
 from lib.podcast_rss_processor import PodcastRSSProcessor
-from lib.config import Config
 from lib.gdrive import GoogleDrive
 
 async def main():
     # Initialize Google Drive service
     try:
-        GoogleDrive.instance()
+        # Credential discovery blocks, so keep it off the event loop
+        gdrive = await asyncio.to_thread(GoogleDrive.instance)
     except Exception as e:
         logger.error(f"Error setting up Google Drive: {e}")
         return
 
     processor = AudioProcessor()
+    await processor.initialize()
+    try:
+        await run(processor, gdrive)
+    finally:
+        await processor.aclose()
+
+async def run(processor: AudioProcessor, gdrive: GoogleDrive):
     podcast_processor = PodcastRSSProcessor()
-    rss_drive_id = podcast_processor.get_rss_feed_id()
-    rss_feed = podcast_processor.download_rss_feed(rss_drive_id)
-    episode_mapping = podcast_processor.extract_episode_mapping(rss_feed)
+    rss_drive_id = await asyncio.to_thread(podcast_processor.get_rss_feed_id)
+    episode_mapping = await asyncio.to_thread(podcast_processor.stream_episode_mapping, rss_drive_id)
 
     results = await processor.check_for_new_m3u8_files(episode_mapping)
     # check for an existing playlist
@@ -73,28 +48,22 @@ async def main():
     
     logger.info(f"Processed {len(results)} audio files")
     for result in results:
-        # Skip upload for reused files that already have download_url
-        if result.get('download_url'):
-            logger.info(f"Skipping upload for reused file: {result['title']}")
-            # Extract drive_file_id from download_url for consistency
-            download_url = result['download_url']
-            if 'id=' in download_url:
-                result['drive_file_id'] = download_url.split('id=')[1].split('&')[0]
-            continue
-            
-        logger.info(f"Uploading {result['title']} to Google Drive")
-        try:
-            drive_file_id = await GoogleDrive.instance().upload_to_drive(result['temp_file'], f"{result['title']}.mp3")
-            os.unlink(result['temp_file'])
+        # Reused files were not uploaded again, recover their drive_file_id for consistency
+        download_url = result.get('download_url')
+        drive_file_id = GoogleDrive.extract_drive_id(download_url) if download_url else None
+        if drive_file_id:
             result['drive_file_id'] = drive_file_id
-        except Exception as e:
-            logger.error(f"Failed to upload {result['title']} to Google Drive: {e}")
-            return
 
     xml_feed = podcast_processor.create_rss_xml(results)
-    rss_drive_id = await GoogleDrive.instance().upload_string_to_drive(xml_feed, "playrun_addict.xml", mimetype='application/rss+xml', file_id=rss_drive_id)
+    rss_drive_id = await gdrive.upload_string_to_drive(xml_feed, "playrun_addict.xml", mimetype='application/rss+xml', file_id=rss_drive_id)
     rss_download_url = GoogleDrive.generate_download_url(rss_drive_id)
     print(f"RSS Feed Download URL: {rss_download_url}")
 
 if __name__ == "__main__":
+    try:
+        # uvloop is optional; fall back to the default event loop when it is not installed
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
     asyncio.run(main())
\ No newline at end of file
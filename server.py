@@ -17,6 +17,10 @@ processor = AudioProcessor()
 async def startup_event():
     await processor.initialize()
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    await processor.aclose()
+
 @app.get("/")
 async def root():
     return {"message": "M3U8 Audio Processor is running"}